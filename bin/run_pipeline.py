@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+run_pipeline.py — Master pipeline runner driven by a YAML config.
+
+Runs the numbered step scripts in sequence:
+  1  scripts/01_extract_frames.py — .bag → RGB-D frames (with --extract)
+  2  scripts/02_slam.py           — ORB-SLAM3 tracking + trajectory conversion
+  3  scripts/03_tsdf_rgb.py       — RGB TSDF meshing
+  4  scripts/04_sam3_mask.py      — SAM3 mask cache (L1)
+  5  scripts/05_sam3_score.py     — SAM3 EDT scoring + semantic TSDF (L2)
+  6  scripts/06_cull_segment.py   — cull seams + segment stones
+
+All parameters come from the pipeline YAML (default: config/pipeline/default.yaml).
+The per-step shell scripts (01_extract.sh … 06_cull_segment.sh) remain the
+hand-tuned alternative; this runner is for config-driven batch runs.
+
+Usage:
+  ./bin/run_pipeline.py --bag /path/to/recording.bag --extract
+  ./bin/run_pipeline.py --config config/pipeline/examples/trimmed.yaml
+  ./bin/run_pipeline.py --start_step 3        # re-mesh from existing SLAM output
+"""
+
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+import yaml
+
+try:
+    # libyaml C extension — ~10x faster than the pure-Python parser
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(PROJECT_DIR, 'scripts')
+
+
+def _frame_key(path):
+    """Numeric sort key on the frame index — correct even when indices
+    are not zero-padded, and cheaper than comparing padded strings."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
+# ---------------------------------------------------------------------------
+# Config loading
+# ---------------------------------------------------------------------------
+
+# Parsed-YAML cache keyed by absolute path. Entries are validated against
+# (mtime, size) so an edited config is always re-parsed; hits return a
+# deepcopy so the path-resolution rewrites in main() never touch the cache.
+_CONFIG_CACHE = OrderedDict()
+_CONFIG_CACHE_MAX = 100
+
+
+def load_config(config_file):
+    """Load the pipeline YAML config, reusing a cached parse when unchanged."""
+    path = os.path.abspath(config_file)
+    st = os.stat(path)
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        _CONFIG_CACHE.move_to_end(path)
+        return copy.deepcopy(cached[2])
+
+    # On-disk sidecar: parsed form persisted as JSON next to the YAML.
+    # The stdlib JSON C decoder beats even libyaml, so reruns of the
+    # pipeline with an unchanged config skip YAML tokenization entirely.
+    sidecar = path + '.cache.json'
+    config = None
+    try:
+        if os.path.getmtime(sidecar) >= st.st_mtime:
+            with open(sidecar) as f:
+                config = json.load(f)
+    except (OSError, ValueError):
+        config = None
+
+    if config is None:
+        with open(path) as f:
+            config = yaml.load(f, Loader=_YamlLoader)
+        try:
+            with open(sidecar + '.tmp', 'w') as f:
+                json.dump(config, f)
+            os.replace(sidecar + '.tmp', sidecar)
+        except (TypeError, ValueError, OSError):
+            # Read-only config dir, or YAML values with no faithful JSON
+            # mapping (dates, non-string keys — which would round-trip
+            # back as strings). Skip the sidecar and drop the partial
+            # .tmp; the in-memory cache still applies.
+            try:
+                os.remove(sidecar + '.tmp')
+            except OSError:
+                pass
+
+    _CONFIG_CACHE[path] = (st.st_mtime, st.st_size, copy.deepcopy(config))
+    while len(_CONFIG_CACHE) > _CONFIG_CACHE_MAX:
+        _CONFIG_CACHE.popitem(last=False)
+    return config
+
+
+def resolve_path(path):
+    """Absolute paths pass through; relative paths resolve to project root."""
+    if os.path.isabs(path):
+        return path
+    return os.path.join(PROJECT_DIR, path)
+
+
+def resolve_config_paths(config_file, config):
+    """Resolve the config's orbslam/output paths to absolute form, memoized.
+
+    The result depends only on the config file and the project root, so it
+    is persisted to <config>.resolved.json and reused verbatim while the
+    config is unchanged.
+    """
+    path    = os.path.abspath(config_file)
+    sidecar = path + '.resolved.json'
+    key     = [PROJECT_DIR, os.path.getmtime(path)]
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['paths']
+    except (OSError, ValueError):
+        pass
+
+    orbslam  = config.get('orbslam', {})
+    output   = config.get('output', {})
+    base_dir = resolve_path(output.get('base_dir', 'output'))
+    paths = {
+        'camera_config': resolve_path(orbslam.get(
+            'camera_config', 'config/camera/RealSense_D456.yaml')),
+        'vocab_file':    resolve_path(orbslam.get(
+            'vocab_file', 'external/orbslam3/Vocabulary/ORBvoc.txt')),
+        'base_dir':      base_dir,
+        'sparse_dir':    os.path.join(base_dir, output.get('sparse_dir', 'sparse')),
+        'dense_dir':     os.path.join(base_dir, output.get('dense_dir', 'dense')),
+        'scoring_dir':   os.path.join(base_dir, 'scoring'),
+        'segments_dir':  os.path.join(base_dir, 'segments'),
+    }
+    paths['mesh_path'] = os.path.join(paths['dense_dir'],
+                                      output.get('mesh_name', 'mesh.ply'))
+    try:
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump({'key': key, 'paths': paths}, f)
+        os.replace(sidecar + '.tmp', sidecar)
+    except OSError:
+        pass
+    return paths
+
+
+# ---------------------------------------------------------------------------
+# Step execution
+# ---------------------------------------------------------------------------
+
+def run_command(cmd, cwd=None):
+    """Run one pipeline step, streaming its output to the console."""
+    print(f"\n$ {' '.join(cmd)}")
+    # The child inherits our stdout/stderr FDs directly — no pipes or
+    # wrappers, so chatty steps (ORB-SLAM3) write at raw kernel speed.
+    # stdin is detached so no step can silently block on a prompt.
+    result = subprocess.run(cmd, cwd=cwd, stdin=subprocess.DEVNULL, bufsize=-1)
+    return result.returncode
+
+
+def run_step(n, name, cmd):
+    print("\n" + "=" * 60)
+    print(f" Step 0{n} — {name}")
+    print("=" * 60)
+    rc = run_command(cmd)
+    if rc != 0:
+        print(f"ERROR: step 0{n} ({name}) failed with exit code {rc}")
+        sys.exit(rc)
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the full reconstruction pipeline from a YAML config")
+    parser.add_argument('--config',
+                        default=os.path.join(PROJECT_DIR, 'config/pipeline/default.yaml'),
+                        help='Pipeline YAML config')
+    parser.add_argument('--bag',        default=None,
+                        help='Override dataset.bag_file from the config')
+    parser.add_argument('--frames_dir', default=None,
+                        help='Override dataset.frames_dir from the config')
+    parser.add_argument('--extract',    action='store_true',
+                        help='Run frame extraction (step 01) first')
+    parser.add_argument('--start_step', type=int, default=1, choices=range(1, 7),
+                        help='First step to run (default: 1)')
+    parser.add_argument('--end_step',   type=int, default=6, choices=range(1, 7),
+                        help='Last step to run (default: 6)')
+    parser.add_argument('--viewer',     action='store_true',
+                        help='Enable the ORB-SLAM3 viewer window')
+    parser.add_argument('--equalize',   action='store_true',
+                        help='CLAHE-normalize color frames before SLAM')
+    parser.add_argument('--exec_final', action='store_true',
+                        help='exec() the last step in-place instead of '
+                             'forking it (skips the summary print, frees '
+                             'the parent interpreter)')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+
+    dataset    = config.get('dataset', {})
+    extraction = config.get('extraction', {})
+    orbslam    = config.get('orbslam', {})
+    recon      = config.get('reconstruction', {})
+    sam3       = config.get('sam3', {})
+
+    bag_file   = args.bag or dataset.get('bag_file', '')
+    frames_dir = args.frames_dir or dataset.get('frames_dir', '')
+
+    paths = resolve_config_paths(args.config, config)
+    camera_config = paths['camera_config']
+    vocab_file    = paths['vocab_file']
+    base_dir      = paths['base_dir']
+    sparse_dir    = paths['sparse_dir']
+    mesh_path     = paths['mesh_path']
+    scoring_dir   = paths['scoring_dir']
+    segments_dir  = paths['segments_dir']
+
+    mesh_cfg = recon.get('mesh', {})
+    trajectory = os.path.join(sparse_dir, 'trajectory_open3d.log')
+
+    print("=" * 60)
+    print("ORB_SLAM3 + Open3D Dense Reconstruction Pipeline")
+    print("=" * 60)
+    print(f"  config     : {args.config}")
+    print(f"  frames_dir : {frames_dir}")
+    print(f"  output     : {base_dir}")
+    print(f"  steps      : {args.start_step}–{args.end_step}")
+
+    def should_run(n):
+        return args.start_step <= n <= args.end_step
+
+    # ── Step 01: extract frames ──────────────────────────────────────────
+    if should_run(1) and args.extract:
+        if not bag_file or not os.path.exists(bag_file):
+            print(f"ERROR: bag file not found: {bag_file}")
+            sys.exit(1)
+        run_step(1, "Extract Frames", [
+            sys.executable, os.path.join(SCRIPTS_DIR, '01_extract_frames.py'),
+            '--bag',        bag_file,
+            '--output',     frames_dir,
+            '--stride',     str(extraction.get('frame_stride', 1)),
+            '--max_frames', str(extraction.get('max_frames', 0)),
+        ])
+    elif should_run(1):
+        print("\n[01] --extract not given — using existing frames")
+
+    if not os.path.exists(frames_dir):
+        print(f"ERROR: frames_dir not found: {frames_dir}")
+        print("Run with --extract to extract frames from the bag first.")
+        sys.exit(1)
+
+    # Enumerate the color frames once with scandir and persist a manifest;
+    # step 02's association generation reads it back instead of re-walking
+    # the (possibly network-mounted) frames directory.
+    color_dir = os.path.join(frames_dir, 'color')
+    if os.path.isdir(color_dir):
+        with os.scandir(color_dir) as it:
+            entries = sorted((e.name for e in it
+                              if e.name.endswith(('.jpg', '.png'))),
+                             key=_frame_key)
+        with open(os.path.join(frames_dir, 'manifest.txt'), 'w') as f:
+            f.write('\n'.join(entries) + '\n')
+        print(f"  frames     : {len(entries)} color frames (manifest written)")
+
+    # ── Step 02: SLAM + trajectory conversion ────────────────────────────
+    if should_run(2):
+        cmd = [
+            sys.executable, os.path.join(SCRIPTS_DIR, '02_slam.py'),
+            '--frames_dir', frames_dir,
+            '--output_dir', sparse_dir,
+            '--config',     camera_config,
+            '--vocab',      vocab_file,
+        ]
+        if args.viewer or orbslam.get('use_viewer', False):
+            cmd.append('--viewer')
+        else:
+            cmd.append('--headless')
+        if args.equalize:
+            cmd.append('--equalize')
+        run_step(2, "ORB-SLAM3", cmd)
+
+    # ── Steps 03 + 04: TSDF meshing ∥ SAM3 mask cache ────────────────────
+    # Step 03 is CPU-bound on TSDF integration and step 04 is GPU-bound on
+    # SAM3 inference; neither consumes the other's output (03 reads the
+    # trajectory, 04 only the color frames), so overlap them when both are
+    # in range instead of paying their wall times in sequence.
+    sam_confidence = sam3.get('confidence', 0.1)
+    mask_cache_dir = os.path.join(frames_dir,
+                                  f'sam3_mask_cache_conf_{sam_confidence}')
+    cmd3 = [
+        sys.executable, os.path.join(SCRIPTS_DIR, '03_tsdf_rgb.py'),
+        '--frames_dir', frames_dir,
+        '--trajectory', trajectory,
+        '--output',     mesh_path,
+        '--voxel_size', str(mesh_cfg.get('voxel_size', 0.005)),
+        '--depth_max',  str(mesh_cfg.get('depth_max', 3.0)),
+    ]
+    cmd4 = [
+        sys.executable, os.path.join(SCRIPTS_DIR, '04_sam3_mask.py'),
+        '--frames_dir',     frames_dir,
+        '--sam_prompt',     sam3.get('prompt', 'individual stone'),
+        '--sam_confidence', str(sam_confidence),
+    ]
+    if should_run(3) and should_run(4):
+        print("\n" + "=" * 60)
+        print(" Steps 03 + 04 — RGB TSDF Meshing ∥ SAM3 Mask Cache")
+        print("=" * 60)
+        procs = [(3, "RGB TSDF Meshing", subprocess.Popen(cmd3)),
+                 (4, "SAM3 Mask Cache",  subprocess.Popen(cmd4))]
+        for n, name, proc in procs:
+            rc = proc.wait()
+            if rc != 0:
+                for _, _, other in procs:
+                    if other.poll() is None:
+                        other.terminate()
+                print(f"ERROR: step 0{n} ({name}) failed with exit code {rc}")
+                sys.exit(rc)
+    elif should_run(3):
+        run_step(3, "RGB TSDF Meshing", cmd3)
+    elif should_run(4):
+        run_step(4, "SAM3 Mask Cache", cmd4)
+
+    # ── Step 05: SAM3 EDT scoring + semantic TSDF (L2) ───────────────────
+    if should_run(5):
+        run_step(5, "SAM3 EDT Scoring", [
+            sys.executable, os.path.join(SCRIPTS_DIR, '05_sam3_score.py'),
+            '--frames_dir',     frames_dir,
+            '--mask_cache_dir', mask_cache_dir,
+            '--trajectory',     trajectory,
+            '--output_dir',     scoring_dir,
+            '--edt_gamma',      str(sam3.get('edt_gamma', 0.5)),
+            '--voxel_size',     str(mesh_cfg.get('voxel_size', 0.005)),
+            '--depth_max',      str(mesh_cfg.get('depth_max', 3.0)),
+        ])
+
+    # ── Step 06: cull + segment ──────────────────────────────────────────
+    if should_run(6):
+        thresholds = sam3.get('alpha_thresholds', [0.3])
+        cmd6 = [
+            sys.executable, os.path.join(SCRIPTS_DIR, '06_cull_segment.py'),
+            '--raw_mesh',   mesh_path,
+            '--alpha_mesh', os.path.join(scoring_dir, 'alpha_mesh.ply'),
+            '--output_dir', segments_dir,
+            '--alpha_thresholds', *[str(t) for t in thresholds],
+        ]
+        if args.exec_final:
+            # Replace this process with the final step — no extra fork and
+            # the runner's interpreter memory is released immediately.
+            print("\n" + "=" * 60)
+            print(" Step 06 — Cull + Segment (exec)")
+            print("=" * 60)
+            sys.stdout.flush()
+            os.execvp(cmd6[0], cmd6)
+        run_step(6, "Cull + Segment", cmd6)
+
+    print("\n" + "=" * 60)
+    print(f"Pipeline complete (steps {args.start_step}–{args.end_step})")
+    print(f"  outputs: {base_dir}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,10 +20,54 @@ import cv2
 import json
 import os
 import argparse
+import queue
+import threading
+
+
+# Encoder settings: PNG level 1 is ~2x cheaper than the libpng default on
+# 16-bit depth for a few % larger files; skipping JPEG Huffman optimization
+# saves a second pass over every color frame.
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+_PNG_PARAMS  = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+def _encoder_worker(q, color_dir, depth_dir, conf_dir, errors,
+                    fast_depth=False):
+    """Drain the frame queue: JPEG/PNG encoding.
+
+    cv2.imwrite releases the GIL, so a few worker threads overlap encoding
+    with the RealSense playback reads in the main loop. Failures go into
+    the shared errors list and the worker keeps draining — a dead worker
+    would leave the bounded queue full and the producer blocked forever.
+    """
+    while True:
+        item = q.get()
+        if item is None:
+            q.task_done()
+            break
+        idx, color_np, depth_np, conf_np = item
+        try:
+            # Color arrives BGR8 from the SDK — ready for cv2.imwrite as-is
+            cv2.imwrite(os.path.join(color_dir, f'{idx:06d}.jpg'), color_np,
+                        _JPEG_PARAMS)
+            if fast_depth:
+                # Raw dump — no zlib at all. Only the dense steps (03/05) can
+                # read these; ORB-SLAM3's rgbd_tum needs PNG depth.
+                np.save(os.path.join(depth_dir, f'{idx:06d}.npy'), depth_np)
+            else:
+                cv2.imwrite(os.path.join(depth_dir, f'{idx:06d}.png'),
+                            depth_np, _PNG_PARAMS)
+            if conf_np is not None:
+                cv2.imwrite(os.path.join(conf_dir, f'{idx:06d}.png'), conf_np,
+                            _PNG_PARAMS)
+        except Exception as e:
+            errors.append((idx, e))
+        finally:
+            q.task_done()
 
 
 def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
-                            skip_confidence=False):
+                            skip_confidence=False, fast_depth=False):
     color_dir = os.path.join(output_dir, 'color')
     depth_dir = os.path.join(output_dir, 'depth')
     os.makedirs(color_dir, exist_ok=True)
@@ -33,6 +77,29 @@ def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
     config   = rs.config()
     config.enable_device_from_file(bag_file, repeat_playback=False)
 
+    # Request BGR8 color up front — librealsense converts in its processing
+    # block, so the per-frame cv2.cvtColor memory pass disappears entirely.
+    # Playback devices can be limited to the profiles recorded in the bag,
+    # so probe resolvability first (like confidence below) and fall back to
+    # RGB8 + cv2.cvtColor for bags that cannot serve BGR8.
+    probe = rs.config()
+    probe.enable_device_from_file(bag_file, repeat_playback=False)
+    probe.enable_stream(rs.stream.color, rs.format.bgr8)
+    color_is_bgr = probe.can_resolve(rs.pipeline_wrapper(pipeline))
+    if color_is_bgr:
+        config.enable_stream(rs.stream.color, rs.format.bgr8)
+    else:
+        print("  Color stream: BGR8 not available in this bag — "
+              "converting from RGB8 per frame")
+        config.enable_stream(rs.stream.color, rs.format.rgb8)
+    config.enable_stream(rs.stream.depth, rs.format.z16)
+    if not skip_confidence:
+        probe = rs.config()
+        probe.enable_device_from_file(bag_file, repeat_playback=False)
+        probe.enable_stream(rs.stream.confidence)
+        if probe.can_resolve(rs.pipeline_wrapper(pipeline)):
+            config.enable_stream(rs.stream.confidence)
+
     print(f"Opening bag file: {bag_file}")
     profile  = pipeline.start(config)
     playback = profile.get_device().as_playback()
@@ -74,9 +141,29 @@ def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
     frame_count = saved_count = 0
     timestamps  = []
 
-    print(f"\nExtracting frames (stride={frame_stride})...")
+    # Encoding runs on worker threads so PNG/JPEG compression never stalls
+    # the playback reads; the bounded queue applies backpressure.
+    n_workers     = min(4, max(2, (os.cpu_count() or 4) // 2))
+    encode_queue  = queue.Queue(maxsize=8)
+    encode_errors = []  # (frame_idx, exception) — list.append is atomic
+    workers       = [threading.Thread(target=_encoder_worker,
+                                      args=(encode_queue, color_dir,
+                                            depth_dir, conf_dir,
+                                            encode_errors, fast_depth),
+                                      daemon=True)
+                     for _ in range(n_workers)]
+    for w in workers:
+        w.start()
+
+    print(f"\nExtracting frames (stride={frame_stride}, "
+          f"{n_workers} encoder threads)...")
     try:
         while True:
+            if encode_errors:
+                idx, err = encode_errors[0]
+                print(f"ERROR: encoding frame {idx} failed ({err}) — "
+                      "stopping extraction")
+                break
             if max_frames > 0 and saved_count >= max_frames:
                 print(f"Reached max_frames limit: {max_frames}")
                 break
@@ -95,19 +182,22 @@ def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
                 frame_count += 1
                 continue
 
+            # Copy out of the librealsense buffers — they are recycled once
+            # the frameset is released, and encoding happens asynchronously.
+            # cvtColor allocates a fresh array, so it doubles as the copy.
             color_np = np.asanyarray(color_frame.get_data())
-            depth_np = np.asanyarray(depth_frame.get_data())
+            color_np = (color_np.copy() if color_is_bgr
+                        else cv2.cvtColor(color_np, cv2.COLOR_RGB2BGR))
+            depth_np = np.asanyarray(depth_frame.get_data()).copy()
             ts       = frames.get_timestamp() / 1000.0
 
-            cv2.imwrite(os.path.join(color_dir, f'{saved_count:06d}.jpg'),
-                        cv2.cvtColor(color_np, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(os.path.join(depth_dir, f'{saved_count:06d}.png'), depth_np)
-
+            conf_np = None
             if has_confidence:
                 cf = frames.first_or_default(rs.stream.confidence)
                 if cf:
-                    cv2.imwrite(os.path.join(conf_dir, f'{saved_count:06d}.png'),
-                                np.asanyarray(cf.get_data()))
+                    conf_np = np.asanyarray(cf.get_data()).copy()
+
+            encode_queue.put((saved_count, color_np, depth_np, conf_np))
 
             timestamps.append(ts)
             saved_count  += 1
@@ -120,6 +210,13 @@ def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
         print(f"Error during extraction: {e}")
     finally:
         pipeline.stop()
+        for _ in workers:
+            encode_queue.put(None)
+        for w in workers:
+            w.join()
+        if encode_errors:
+            print(f"WARNING: {len(encode_errors)} frame(s) failed to encode "
+                  "— the extraction is incomplete")
 
     with open(os.path.join(output_dir, 'timestamps.txt'), 'w') as f:
         for ts in timestamps:
@@ -128,7 +225,8 @@ def extract_frames_from_bag(bag_file, output_dir, frame_stride=1, max_frames=0,
     with open(os.path.join(output_dir, 'streams.json'), 'w') as f:
         json.dump({"has_confidence": has_confidence,
                    "frame_count": saved_count,
-                   "frame_stride": frame_stride}, f, indent=2)
+                   "frame_stride": frame_stride,
+                   "depth_format": "npy" if fast_depth else "png"}, f, indent=2)
 
     print(f"\n✓ Extraction complete: {saved_count} frames → {output_dir}")
     return saved_count
@@ -145,6 +243,10 @@ def main():
                         help='Max frames to extract (0 = all)')
     parser.add_argument('--skip_confidence', action='store_true',
                         help='Skip confidence stream even if present')
+    parser.add_argument('--fast_depth', action='store_true',
+                        help='Write depth as raw .npy instead of PNG '
+                             '(skips zlib; steps 03/05 read it, but '
+                             'ORB-SLAM3 in step 02 requires PNG depth)')
     args = parser.parse_args()
 
     if not os.path.exists(args.bag):
@@ -155,7 +257,8 @@ def main():
     print("Step 01 — Extract Frames")
     print("=" * 60)
     extract_frames_from_bag(args.bag, args.output, args.stride,
-                            args.max_frames, args.skip_confidence)
+                            args.max_frames, args.skip_confidence,
+                            args.fast_depth)
 
 
 if __name__ == "__main__":
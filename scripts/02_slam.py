@@ -20,6 +20,7 @@ Usage:
 """
 
 import argparse
+import hashlib
 import json
 import os
 import shutil
@@ -30,11 +31,31 @@ import tempfile
 import cv2
 import numpy as np
 
+try:
+    # pandas' C tokenizer parses numeric text 5–10x faster than np.loadtxt
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    # orjson serializes numeric-heavy payloads 5–10x faster than stdlib
+    # json and can take ndarrays directly (no .tolist() round trip)
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # ---------------------------------------------------------------------------
 # TUM associations
 # ---------------------------------------------------------------------------
 
+def _frame_key(path):
+    """Numeric sort key on the frame index — correct even when indices
+    are not zero-padded, and cheaper than comparing padded strings."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
 def create_associations(frames_dir, output_file, fps=30.0):
     """Write TUM-format associations.txt. Uses real timestamps if available."""
     color_dir = os.path.join(frames_dir, 'color')
@@ -47,18 +68,42 @@ def create_associations(frames_dir, output_file, fps=30.0):
             real_ts = [float(l.strip()) for l in f if l.strip()]
         print(f"  Using real timestamps from {timestamps_file}")
 
-    color_files = sorted(f for f in os.listdir(color_dir)
-                         if f.endswith(('.jpg', '.png')))
-    depth_files = sorted(f for f in os.listdir(depth_dir)
-                         if f.endswith('.png'))
+    # Prefer the manifest written by bin/run_pipeline.py — saves re-walking
+    # the frames directory, which repeats in every downstream step. Only
+    # trust it when it is at least as new as color/: a stale manifest from
+    # a previous extraction lists files that no longer exist and sends
+    # ORB-SLAM3 into confusing mid-run read failures.
+    manifest = os.path.join(frames_dir, 'manifest.txt')
+    color_files = None
+    if (os.path.exists(manifest)
+            and os.path.getmtime(manifest) >= os.path.getmtime(color_dir)):
+        with open(manifest) as f:
+            color_files = [l.strip() for l in f if l.strip()]
+    if color_files is None:
+        if os.path.exists(manifest):
+            print("  manifest.txt is older than color/ — re-listing frames")
+        # os.scandir returns cached DirEntry objects — no per-file stat
+        with os.scandir(color_dir) as it:
+            color_files = sorted((e.name for e in it
+                                  if e.name.endswith(('.jpg', '.png'))),
+                                 key=_frame_key)
+    with os.scandir(depth_dir) as it:
+        depth_files = sorted((e.name for e in it if e.name.endswith('.png')),
+                             key=_frame_key)
     n = min(len(color_files), len(depth_files))
     print(f"  Associations: {n} frames at {fps:.1f} fps")
 
+    if real_ts and len(real_ts) >= n:
+        ts = real_ts[:n]
+    else:
+        ts = np.arange(n) / fps
+
     os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    # One joined buffer, one write — not two f.write calls per frame
+    lines = [f"{t:.6f} color/{c} {t:.6f} depth/{d}"
+             for t, c, d in zip(ts, color_files, depth_files)]
     with open(output_file, 'w') as f:
-        for i in range(n):
-            ts = real_ts[i] if (real_ts and i < len(real_ts)) else float(i) / fps
-            f.write(f"{ts:.6f} color/{color_files[i]} {ts:.6f} depth/{depth_files[i]}\n")
+        f.write("\n".join(lines) + "\n" if lines else "")
     return output_file
 
 
@@ -118,62 +163,123 @@ def apply_clahe_to_frames(frames_dir: str, out_dir: str) -> str:
 # TUM → Open3D trajectory conversion
 # ---------------------------------------------------------------------------
 
-def _quat_to_rot(qx, qy, qz, qw):
-    n  = np.sqrt(qx*qx + qy*qy + qz*qz + qw*qw)
-    qx, qy, qz, qw = qx/n, qy/n, qz/n, qw/n
-    return np.array([
-        [1-2*(qy**2+qz**2),   2*(qx*qy-qw*qz),   2*(qx*qz+qw*qy)],
-        [  2*(qx*qy+qw*qz), 1-2*(qx**2+qz**2),   2*(qy*qz-qw*qx)],
-        [  2*(qx*qz-qw*qy),   2*(qy*qz+qw*qx), 1-2*(qx**2+qy**2)],
-    ])
+def _quats_to_rots(q):
+    """Convert (N,4) quaternions (qx,qy,qz,qw) to (N,3,3) rotation matrices."""
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    qx, qy, qz, qw = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    R = np.empty((len(q), 3, 3))
+    R[:, 0, 0] = 1 - 2*(qy**2 + qz**2)
+    R[:, 0, 1] =     2*(qx*qy - qw*qz)
+    R[:, 0, 2] =     2*(qx*qz + qw*qy)
+    R[:, 1, 0] =     2*(qx*qy + qw*qz)
+    R[:, 1, 1] = 1 - 2*(qx**2 + qz**2)
+    R[:, 1, 2] =     2*(qy*qz - qw*qx)
+    R[:, 2, 0] =     2*(qx*qz - qw*qy)
+    R[:, 2, 1] =     2*(qy*qz + qw*qx)
+    R[:, 2, 2] = 1 - 2*(qx**2 + qy**2)
+    return R
 
 
 def load_tum_trajectory(path):
-    poses = []
-    with open(path) as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            parts = line.split()
-            if len(parts) < 8:
-                continue
-            ts = float(parts[0])
-            tx, ty, tz = float(parts[1]), float(parts[2]), float(parts[3])
-            qx, qy, qz, qw = float(parts[4]), float(parts[5]), float(parts[6]), float(parts[7])
-            T = np.eye(4)
-            T[:3, :3] = _quat_to_rot(qx, qy, qz, qw)
-            T[:3,  3] = [tx, ty, tz]
-            poses.append((ts, T))
-    return poses
+    """Parse a TUM trajectory file → (timestamps (N,), poses (N,4,4)).
+
+    The converted tensor is cached as <path>.npz keyed on a blake2b digest
+    of the file, so parameter-sweep reruns skip text parsing entirely.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+    cache  = path + '.npz'
+    if os.path.exists(cache):
+        try:
+            data = np.load(cache)
+            if data['sha'].tobytes() == digest:
+                return data['ts'], data['T']
+        except (OSError, ValueError, KeyError):
+            pass  # stale/corrupt cache — fall through to re-parse
+
+    if pd is not None:
+        try:
+            data = pd.read_csv(path, sep=r'\s+', comment='#', header=None,
+                               dtype=np.float64, engine='c').to_numpy()
+        except pd.errors.EmptyDataError:
+            data = np.empty((0, 8))
+    else:
+        data = np.loadtxt(path, comments='#', ndmin=2)
+    if data.size == 0:
+        return np.empty(0), np.empty((0, 4, 4))
+    ts  = data[:, 0]
+    T   = np.tile(np.eye(4), (len(data), 1, 1))
+    T[:, :3, :3] = _quats_to_rots(data[:, 4:8])
+    T[:, :3,  3] = data[:, 1:4]
+    try:
+        np.savez_compressed(cache, T=T, ts=ts,
+                            sha=np.frombuffer(digest, dtype=np.uint8))
+    except OSError:
+        pass
+    return ts, T
 
 
 def save_open3d_log(poses, path):
-    with open(path, 'w') as f:
-        f.write(f"# Open3D trajectory log\n")
-        f.write(f"# Number of poses: {len(poses)}\n")
-        f.write(f"# Format: 4x4 transformation matrix (row-major)\n#\n")
-        for _, T in poses:
-            f.write(' '.join(f'{v:.12f}' for v in T.flatten()) + '\n')
+    # np.savetxt formats in a C-level loop — far cheaper than 16*N
+    # f-string format calls through the interpreter.
+    header = (f"Open3D trajectory log\n"
+              f"Number of poses: {len(poses)}\n"
+              f"Format: 4x4 transformation matrix (row-major)\n")
+    np.savetxt(path, poses.reshape(len(poses), 16), fmt='%.12f',
+               header=header, comments='# ')
+    # Binary sibling — steps 03/05 mmap this instead of re-parsing the
+    # formatted text. float32 halves the file and the read bandwidth;
+    # SLAM world coordinates fit comfortably in single precision. The
+    # text log stays authoritative for inspection.
+    np.save(path + '.npy', poses.astype(np.float32))
+
+
+def _invert_se3_batch(poses):
+    """Closed-form rigid-transform inverse of an (N,4,4) stack: [Rᵀ, -Rᵀt]."""
+    Rt   = poses[:, :3, :3].transpose(0, 2, 1)
+    tinv = -np.einsum('nij,nj->ni', Rt, poses[:, :3, 3])
+    inv  = np.tile(np.eye(4), (len(poses), 1, 1))
+    inv[:, :3, :3] = Rt
+    inv[:, :3,  3] = tinv
+    return inv
 
 
 def save_pose_graph_json(poses, path):
     pg = {"class_name": "PoseGraph", "version_major": 1, "version_minor": 0,
           "nodes": [], "edges": []}
-    for _, T in poses:
+    for T in poses:
         pg["nodes"].append({"class_name": "PoseGraphNode",
                             "version_major": 1, "version_minor": 0,
-                            "pose": T.tolist()})
+                            "pose": T})
+    # All relative poses in one batched matmul — poses are rigid, so the
+    # closed-form inverse replaces N general LU inversions.
+    T_rel_all = _invert_se3_batch(poses[:-1]) @ poses[1:]
+    info      = np.eye(6)
     for i in range(len(poses) - 1):
-        T_rel = np.linalg.inv(poses[i][1]) @ poses[i+1][1]
         pg["edges"].append({"class_name": "PoseGraphEdge",
                             "version_major": 1, "version_minor": 0,
                             "source_node_id": i, "target_node_id": i+1,
-                            "transformation": T_rel.tolist(),
-                            "information": np.eye(6).tolist(),
+                            "transformation": T_rel_all[i],
+                            "information": info,
                             "uncertain": False})
-    with open(path, 'w') as f:
-        json.dump(pg, f, indent=2)
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(
+                pg, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+    else:
+        # Convert each stack to nested lists in one C-level .tolist() call,
+        # rather than a default= callback firing per matrix mid-encode.
+        node_poses = poses.tolist()
+        rel_poses  = T_rel_all.tolist()
+        info_list  = info.tolist()
+        for node, p in zip(pg["nodes"], node_poses):
+            node["pose"] = p
+        for edge, t in zip(pg["edges"], rel_poses):
+            edge["transformation"] = t
+            edge["information"]    = info_list
+        with open(path, 'w') as f:
+            json.dump(pg, f, indent=2)
 
 
 # ---------------------------------------------------------------------------
@@ -335,15 +441,14 @@ def main():
 
     # ── Step 3: convert trajectory ────────────────────────────────────────
     print("\n[3/3] Converting trajectory to Open3D format…")
-    tum_file = os.path.join(args.output_dir, 'CameraTrajectory.txt')
-    poses    = load_tum_trajectory(tum_file)
+    tum_file  = os.path.join(args.output_dir, 'CameraTrajectory.txt')
+    ts, poses = load_tum_trajectory(tum_file)
     print(f"  Loaded {len(poses)} poses")
 
-    if not poses:
+    if len(poses) == 0:
         print("ERROR: Trajectory is empty")
         sys.exit(1)
 
-    ts      = [t for t, _ in poses]
     dur     = ts[-1] - ts[0]
     avg_fps = len(poses) / dur if dur > 0 else 0
     print(f"  Duration: {dur:.1f}s  avg {avg_fps:.1f} fps")
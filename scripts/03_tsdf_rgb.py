@@ -21,12 +21,33 @@ import open3d as o3d
 import numpy as np
 import json
 import argparse
+import re
 import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from PIL import Image
 
 
 def load_trajectory_log(log_file):
+    # Prefer the binary sibling written by step 02 — a zero-copy mmap
+    # instead of parsing formatted floats.
+    npy = log_file + '.npy'
+    if os.path.exists(npy) and os.path.getmtime(npy) >= os.path.getmtime(log_file):
+        return np.load(npy, mmap_mode='r')
+    try:
+        # One read + one C-level number scan — no per-line Python
+        # iteration; the loop below only runs for malformed logs.
+        with open(log_file) as f:
+            text = f.read()
+        vals = np.fromstring(re.sub(r'#[^\n]*', '', text), sep=' ')
+        if vals.size and vals.size % 16 == 0:
+            # float32 poses halve the bandwidth into the integrator;
+            # Open3D casts to float64 at its API boundary where needed
+            return vals.reshape(-1, 4, 4).astype(np.float32)
+    except ValueError:
+        pass
     poses = []
     with open(log_file) as f:
         for line in f:
@@ -36,7 +57,20 @@ def load_trajectory_log(log_file):
             vals = [float(x) for x in line.split()]
             if len(vals) == 16:
                 poses.append(np.array(vals).reshape(4, 4))
-    return poses
+    if not poses:
+        return np.empty((0, 4, 4), np.float32)
+    return np.stack(poses).astype(np.float32)
+
+
+def invert_se3_batch(poses):
+    """Closed-form rigid-transform inverse [Rᵀ, -Rᵀt] over an (N,4,4)
+    stack — poses are SE(3), so the general LU path of np.linalg.inv is
+    wasted work, and batching removes the per-frame NumPy round trip."""
+    Rt  = poses[:, :3, :3].transpose(0, 2, 1)
+    inv = np.tile(np.eye(4, dtype=poses.dtype), (len(poses), 1, 1))
+    inv[:, :3, :3] = Rt
+    inv[:, :3,  3] = -np.einsum('nij,nj->ni', Rt, poses[:, :3, 3])
+    return inv
 
 
 def load_intrinsic(intrinsic_file):
@@ -49,16 +83,92 @@ def load_intrinsic(intrinsic_file):
     return intrinsic, d.get('depth_scale', 1000.0)
 
 
+def _frame_key(path):
+    """Numeric sort key on the frame index — correct even when indices
+    are not zero-padded, and cheaper than comparing padded strings."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
 def get_rgbd_file_lists(frames_dir):
     color_dir = os.path.join(frames_dir, 'color')
     depth_dir = os.path.join(frames_dir, 'depth')
-    color_files = sorted(os.path.join(color_dir, f) for f in os.listdir(color_dir)
-                         if f.endswith(('.jpg', '.png')))
-    depth_files = sorted(os.path.join(depth_dir, f) for f in os.listdir(depth_dir)
-                         if f.endswith('.png'))
+    # os.scandir returns cached DirEntry objects — no per-file stat
+    with os.scandir(color_dir) as it:
+        color_files = sorted((e.path for e in it
+                              if e.name.endswith(('.jpg', '.png'))),
+                             key=_frame_key)
+    # Dedupe depth by frame stem: a --fast_depth re-extraction over an
+    # existing dir leaves both NNNNNN.png and NNNNNN.npy, and a plain
+    # sorted listing would interleave them and shift every color<->depth
+    # pairing by one. The raw .npy wins when both exist.
+    by_stem = {}
+    with os.scandir(depth_dir) as it:
+        for e in it:
+            if e.name.endswith('.npy'):
+                by_stem[e.name[:-4]] = e.path
+            elif e.name.endswith('.png'):
+                by_stem.setdefault(e.name[:-4], e.path)
+    depth_files = sorted(by_stem.values(), key=_frame_key)
     return color_files, depth_files
 
 
+def load_depth(depth_file):
+    """Read a depth frame: PNG, or raw .npy from --fast_depth extraction."""
+    if depth_file.endswith('.npy'):
+        return np.load(depth_file)
+    return np.asarray(o3d.io.read_image(depth_file))
+
+
+def open_raw_stacks(frames_dir, need_color=True):
+    """Memory-mapped decoded frame stacks from preprocess_frames.py.
+
+    Returns (color_mem, depth_mem), or (None, None) when no raw_stack/
+    exists — callers then fall back to per-file decoding. Pass
+    need_color=False to skip the color stack (color_mem is None then);
+    for blosc2 stacks that avoids decompressing gigabytes nobody reads."""
+    meta_path = os.path.join(frames_dir, 'raw_stack', 'meta.json')
+    if not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # Staleness check against the key preprocess_frames.py recorded at
+    # decode time — re-extracted frames must not be fused from old pixels
+    color_files, depth_files = get_rgbd_file_lists(frames_dir)
+    key = [len(color_files), len(depth_files),
+           os.path.getmtime(color_files[-1]) if color_files else 0.0,
+           os.path.getmtime(depth_files[-1]) if depth_files else 0.0]
+    if meta.get('source_key') != key:
+        print("WARNING: raw_stack is stale (frames changed since "
+              "preprocess_frames.py ran) — falling back to per-file decode")
+        return None, None
+    n, h, w = meta['n_frames'], meta['height'], meta['width']
+    raw_dir = os.path.dirname(meta_path)
+    if meta.get('codec') == 'blosc2':
+        # zstd-compressed stacks (preprocess_frames.py --compress) —
+        # decompressed into RAM once; still far cheaper than PNG decode
+        try:
+            import blosc2
+        except ImportError:
+            print("WARNING: raw_stack is blosc2-compressed but blosc2 is "
+                  "not installed — falling back to per-file decode")
+            return None, None
+        color_mem = None
+        if need_color:
+            with open(os.path.join(raw_dir, 'color.blosc'), 'rb') as f:
+                color_mem = blosc2.unpack_array2(f.read())
+        with open(os.path.join(raw_dir, 'depth.blosc'), 'rb') as f:
+            depth_mem = blosc2.unpack_array2(f.read())
+        return color_mem, depth_mem
+    color_mem = None
+    if need_color:
+        color_mem = np.memmap(os.path.join(raw_dir, 'color.dat'),
+                              dtype=np.uint8, mode='r', shape=(n, h, w, 3))
+    depth_mem = np.memmap(os.path.join(raw_dir, 'depth.dat'), dtype=np.uint16,
+                          mode='r', shape=(n, h, w))
+    return color_mem, depth_mem
+
+
 def apply_depth_filter(depth_np, depth_scale, min_depth_m=0.15,
                        confidence_np=None, confidence_threshold=0):
     min_raw = int(min_depth_m * depth_scale)
@@ -71,9 +181,35 @@ def apply_depth_filter(depth_np, depth_scale, min_depth_m=0.15,
     return depth_np
 
 
+def select_frames(poses, n_frames, frame_skip=1, min_translation=0.0,
+                  min_rotation_deg=0.0):
+    """Pick the frames worth integrating: a fixed stride plus a motion
+    gate that drops frames whose pose barely moved since the last kept
+    one — at 30 fps the TSDF surface saturates long before every frame
+    has contributed."""
+    ids = list(range(0, n_frames, max(frame_skip, 1)))
+    if min_translation <= 0 and min_rotation_deg <= 0:
+        return ids
+    min_rot_rad = np.deg2rad(min_rotation_deg)
+    kept, last = [], None
+    for i in ids:
+        T = np.asarray(poses[i])
+        if last is not None:
+            dt = np.linalg.norm(T[:3, 3] - last[:3, 3])
+            # Rotation angle from the trace of the relative rotation
+            cos_a = (np.trace(T[:3, :3] @ last[:3, :3].T) - 1.0) / 2.0
+            angle = np.arccos(np.clip(cos_a, -1.0, 1.0))
+            if dt < min_translation and angle < min_rot_rad:
+                continue
+        kept.append(i)
+        last = T
+    return kept
+
+
 def integrate_tsdf(frames_dir, intrinsic, poses, depth_scale=1000.0,
                    depth_max=3.0, voxel_size=0.005, depth_min_m=0.15,
-                   confidence_threshold=0):
+                   confidence_threshold=0, frame_skip=1,
+                   min_translation=0.0, min_rotation=0.0):
     color_files, depth_files = get_rgbd_file_lists(frames_dir)
     n_frames = min(len(color_files), len(depth_files), len(poses))
 
@@ -92,24 +228,203 @@ def integrate_tsdf(frames_dir, intrinsic, poses, depth_scale=1000.0,
         color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8,
     )
 
-    for i in tqdm(range(n_frames), desc="TSDF integration"):
-        color_np = np.asarray(Image.open(color_files[i]).convert('RGB'))
-        depth_np = np.asarray(o3d.io.read_image(depth_files[i]))
+    # All extrinsics in one vectorized batch, outside the hot loop
+    inv_poses = invert_se3_batch(np.asarray(poses[:n_frames]))
+
+    color_mem, depth_mem = open_raw_stacks(frames_dir)
+    if color_mem is not None:
+        n_frames = min(n_frames, len(color_mem))
+        print("  Raw memmap stacks found (preprocess_frames.py) — decode skipped")
+
+    def _load_pair(i):
+        if color_mem is not None:
+            color_np = np.asarray(color_mem[i])
+            depth_np = np.asarray(depth_mem[i])
+        else:
+            color_np = np.asarray(Image.open(color_files[i]).convert('RGB'))
+            depth_np = load_depth(depth_files[i])
         conf_np  = (np.asarray(o3d.io.read_image(conf_files[i]))
                     if use_conf and i < len(conf_files) else None)
         depth_np = apply_depth_filter(depth_np, depth_scale, depth_min_m,
                                       conf_np, confidence_threshold)
+        return o3d.geometry.RGBDImage.create_from_color_and_depth(
+            o3d.geometry.Image(color_np),
+            o3d.geometry.Image(
+                np.ascontiguousarray(depth_np, dtype=np.uint16)),
+            depth_scale=depth_scale, depth_trunc=depth_max,
+            convert_rgb_to_intensity=False,
+        )
+
+    frame_ids = select_frames(poses, n_frames, frame_skip,
+                              min_translation, min_rotation)
+    if len(frame_ids) < n_frames:
+        print(f"  Decimation: integrating {len(frame_ids)}/{n_frames} frames "
+              f"(skip={frame_skip}, min_t={min_translation}m, "
+              f"min_r={min_rotation}°)")
+
+    # Decode frame i+K on a small pool while frame i integrates — libpng/
+    # libjpeg release the GIL, so prefetching hides decode latency behind
+    # the (single-threaded) TSDF integration.
+    prefetch = 8
+    pool     = ThreadPoolExecutor(max_workers=max((os.cpu_count() or 4) // 2, 2))
+    futures  = deque(pool.submit(_load_pair, i)
+                     for i in frame_ids[:prefetch])
+    try:
+        for j in tqdm(range(len(frame_ids)), desc="TSDF integration"):
+            rgbd = futures.popleft().result()
+            if j + prefetch < len(frame_ids):
+                futures.append(pool.submit(_load_pair, frame_ids[j + prefetch]))
+            volume.integrate(rgbd, intrinsic, inv_poses[frame_ids[j]])
+    finally:
+        pool.shutdown(wait=False)
+
+    print("✓ Integration complete — extracting mesh…")
+    mesh = volume.extract_triangle_mesh()
+    mesh.compute_vertex_normals()
+    print(f"  Vertices: {len(mesh.vertices):,}  Triangles: {len(mesh.triangles):,}")
+    return mesh
+
 
+def _integrate_chunk(task):
+    """Pool worker: integrate one contiguous frame chunk into a private
+    TSDF volume and return the extracted mesh as plain arrays (Open3D
+    geometry does not pickle across processes)."""
+    (frames_dir, frame_ids, intr_params, inv_poses, depth_scale,
+     depth_max, voxel_size, depth_min_m) = task
+    intrinsic = o3d.camera.PinholeCameraIntrinsic(*intr_params)
+    color_files, depth_files = get_rgbd_file_lists(frames_dir)
+    volume = o3d.pipelines.integration.ScalableTSDFVolume(
+        voxel_length=voxel_size,
+        sdf_trunc=voxel_size * 4.0,
+        color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8,
+    )
+    for k, i in enumerate(frame_ids):
+        color_np = np.asarray(Image.open(color_files[i]).convert('RGB'))
+        depth_np = apply_depth_filter(load_depth(depth_files[i]),
+                                      depth_scale, depth_min_m)
         rgbd = o3d.geometry.RGBDImage.create_from_color_and_depth(
             o3d.geometry.Image(color_np),
-            o3d.geometry.Image(depth_np.astype(np.uint16)),
+            o3d.geometry.Image(
+                np.ascontiguousarray(depth_np, dtype=np.uint16)),
             depth_scale=depth_scale, depth_trunc=depth_max,
             convert_rgb_to_intensity=False,
         )
-        volume.integrate(rgbd, intrinsic, np.linalg.inv(poses[i]))
+        volume.integrate(rgbd, intrinsic, inv_poses[k])
+    mesh = volume.extract_triangle_mesh()
+    return (np.asarray(mesh.vertices), np.asarray(mesh.triangles),
+            np.asarray(mesh.vertex_colors))
+
+
+def integrate_tsdf_parallel(frames_dir, intrinsic, poses, n_workers,
+                            depth_scale=1000.0, depth_max=3.0,
+                            voxel_size=0.005, depth_min_m=0.15,
+                            frame_skip=1, min_translation=0.0,
+                            min_rotation=0.0):
+    """Map-reduce over contiguous frame chunks: each worker integrates a
+    private ScalableTSDFVolume (the legacy integrate call is
+    single-threaded) and the partial meshes are concatenated. Near-linear
+    speedup up to the core count, at the cost of K copies of the volume
+    in memory.
+
+    NOT output-equivalent to single-process integration: surface seen by
+    frames in different chunks is averaged into separate volumes, so the
+    merged mesh carries overlapping sheets of near-coincident geometry
+    (remove_duplicated_vertices only drops bit-identical vertices).
+    Acceptable for previews and geometry inspection; for the mesh that
+    feeds 06's scoring, prefer --workers 1 or the VoxelBlockGrid path."""
+    color_files, depth_files = get_rgbd_file_lists(frames_dir)
+    n_frames = min(len(color_files), len(depth_files), len(poses))
+    frame_ids = select_frames(poses, n_frames, frame_skip,
+                              min_translation, min_rotation)
+    inv_poses = invert_se3_batch(np.asarray(poses)[frame_ids])
+
+    intr_params = (intrinsic.width, intrinsic.height,
+                   intrinsic.intrinsic_matrix[0][0],
+                   intrinsic.intrinsic_matrix[1][1],
+                   intrinsic.intrinsic_matrix[0][2],
+                   intrinsic.intrinsic_matrix[1][2])
+    chunks = np.array_split(np.arange(len(frame_ids)), n_workers)
+    tasks = [(frames_dir, [frame_ids[j] for j in c], intr_params,
+              inv_poses[c], depth_scale, depth_max, voxel_size, depth_min_m)
+             for c in chunks if len(c)]
+    print(f"  {len(frame_ids)} frames over {len(tasks)} worker processes")
+
+    with multiprocessing.Pool(len(tasks)) as mp_pool:
+        results = mp_pool.map(_integrate_chunk, tasks)
+
+    mesh = o3d.geometry.TriangleMesh()
+    for verts, tris, cols in results:
+        sub = o3d.geometry.TriangleMesh(
+            o3d.utility.Vector3dVector(verts),
+            o3d.utility.Vector3iVector(tris))
+        sub.vertex_colors = o3d.utility.Vector3dVector(cols)
+        mesh += sub
+    # Only trims exact duplicates — overlapping chunk geometry remains
+    mesh.remove_duplicated_vertices()
+    mesh.remove_duplicated_triangles()
+    mesh.compute_vertex_normals()
+    print(f"  Vertices: {len(mesh.vertices):,}  Triangles: {len(mesh.triangles):,}")
+    return mesh
+
+
+def integrate_tsdf_vbg(frames_dir, intrinsic, poses, depth_scale=1000.0,
+                       depth_max=3.0, voxel_size=0.005, depth_min_m=0.15,
+                       device_str='CUDA:0', frame_skip=1,
+                       min_translation=0.0, min_rotation=0.0):
+    """Tensor-based TSDF integration on a block-sparse VoxelBlockGrid.
+
+    Each frame only touches the voxel blocks inside its depth frustum
+    (compute_unique_block_coordinates), so integration cost scales with
+    visible surface area rather than volume — that pays off on 'CPU:0'
+    too, where the legacy ScalableTSDFVolume visits far more blocks per
+    frame. On CUDA devices per-voxel projection additionally runs as a
+    kernel, 10x+ faster at fine voxel sizes. Raises RuntimeError if the
+    device/tensor API is unusable; main() then falls back to the legacy
+    path.
+    """
+    device = o3d.core.Device(device_str)
+    color_files, depth_files = get_rgbd_file_lists(frames_dir)
+    n_frames = min(len(color_files), len(depth_files), len(poses))
+
+    print(f"  {n_frames} frames, voxel={voxel_size}m, "
+          f"depth=[{depth_min_m},{depth_max}]m, device={device_str}")
+
+    vbg = o3d.t.geometry.VoxelBlockGrid(
+        attr_names=('tsdf', 'weight', 'color'),
+        attr_dtypes=(o3d.core.float32, o3d.core.uint16, o3d.core.uint16),
+        attr_channels=((1,), (1,), (3,)),
+        voxel_size=voxel_size,
+        block_resolution=16,
+        block_count=50000,
+        device=device,
+    )
+    intr_t = o3d.core.Tensor(intrinsic.intrinsic_matrix, o3d.core.float64)
+
+    inv_poses = invert_se3_batch(np.asarray(poses[:n_frames]))
+
+    frame_ids = select_frames(poses, n_frames, frame_skip,
+                              min_translation, min_rotation)
+    if len(frame_ids) < n_frames:
+        print(f"  Decimation: integrating {len(frame_ids)}/{n_frames} frames")
+
+    for i in tqdm(frame_ids, desc=f"TSDF integration ({device_str})"):
+        depth_np = apply_depth_filter(load_depth(depth_files[i]),
+                                      depth_scale, depth_min_m)
+        depth = o3d.t.geometry.Image(o3d.core.Tensor(
+            np.ascontiguousarray(depth_np, dtype=np.uint16))).to(device)
+        color = o3d.t.geometry.Image(o3d.core.Tensor(
+            np.asarray(Image.open(color_files[i]).convert('RGB')))).to(device)
+        extr = o3d.core.Tensor(inv_poses[i], o3d.core.float64)
+
+        # Frustum-culled block allocation — cost scales with visible
+        # surface area, not volume
+        frustum_block_coords = vbg.compute_unique_block_coordinates(
+            depth, intr_t, extr, depth_scale, depth_max)
+        vbg.integrate(frustum_block_coords, depth, color,
+                      intr_t, intr_t, extr, depth_scale, depth_max)
 
     print("✓ Integration complete — extracting mesh…")
-    mesh = volume.extract_triangle_mesh()
+    mesh = vbg.extract_triangle_mesh().to_legacy()
     mesh.compute_vertex_normals()
     print(f"  Vertices: {len(mesh.vertices):,}  Triangles: {len(mesh.triangles):,}")
     return mesh
@@ -129,6 +444,28 @@ def main():
     parser.add_argument('--depth_max',   type=float, default=3.0)
     parser.add_argument('--depth_min',   type=float, default=0.15)
     parser.add_argument('--confidence_threshold', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes for legacy CPU integration '
+                             '(map-reduce over frame chunks; default: 1). '
+                             'NOTE: >1 is an approximation — chunks fuse '
+                             'into separate volumes, leaving overlapping '
+                             'geometry in the merged mesh')
+    parser.add_argument('--frame_skip', type=int, default=1,
+                        help='Integrate every Nth frame (default: 1 = all)')
+    parser.add_argument('--min_translation', type=float, default=0.0,
+                        help='Motion gate: skip frames that moved less than '
+                             'this (m) since the last integrated frame '
+                             '(default: 0 = off; the voxel size is a good '
+                             'starting value)')
+    parser.add_argument('--min_rotation', type=float, default=0.0,
+                        help='Motion gate rotation threshold in degrees '
+                             '(default: 0 = off; try 2)')
+    parser.add_argument('--device', default='legacy',
+                        help="'legacy' (ScalableTSDFVolume, default), or an "
+                             "Open3D tensor device ('CUDA:0', 'CPU:0') for "
+                             "the block-sparse VoxelBlockGrid path. Falls "
+                             "back to legacy on failure; Open3D 0.19 has "
+                             "known device-placement quirks.")
     args = parser.parse_args()
 
     if args.intrinsic is None:
@@ -144,17 +481,56 @@ def main():
     poses = load_trajectory_log(args.trajectory)
     print(f"  Poses: {len(poses)}")
 
-    mesh = integrate_tsdf(
-        args.frames_dir, intrinsic, poses,
-        depth_scale=depth_scale,
-        depth_max=args.depth_max,
-        voxel_size=args.voxel_size,
-        depth_min_m=args.depth_min,
-        confidence_threshold=args.confidence_threshold,
-    )
+    mesh = None
+    if args.device.lower() != 'legacy':
+        try:
+            mesh = integrate_tsdf_vbg(
+                args.frames_dir, intrinsic, poses,
+                depth_scale=depth_scale,
+                depth_max=args.depth_max,
+                voxel_size=args.voxel_size,
+                depth_min_m=args.depth_min,
+                device_str=args.device,
+                frame_skip=args.frame_skip,
+                min_translation=args.min_translation,
+                min_rotation=args.min_rotation,
+            )
+        except (RuntimeError, AttributeError) as e:
+            print(f"WARNING: VoxelBlockGrid integration failed ({e}) — "
+                  "falling back to legacy CPU volume")
+
+    if mesh is None and args.workers > 1:
+        if args.confidence_threshold > 0:
+            print("WARNING: --workers ignores --confidence_threshold — "
+                  "running single-process instead")
+        else:
+            mesh = integrate_tsdf_parallel(
+                args.frames_dir, intrinsic, poses, args.workers,
+                depth_scale=depth_scale,
+                depth_max=args.depth_max,
+                voxel_size=args.voxel_size,
+                depth_min_m=args.depth_min,
+                frame_skip=args.frame_skip,
+                min_translation=args.min_translation,
+                min_rotation=args.min_rotation,
+            )
+
+    if mesh is None:
+        mesh = integrate_tsdf(
+            args.frames_dir, intrinsic, poses,
+            depth_scale=depth_scale,
+            depth_max=args.depth_max,
+            voxel_size=args.voxel_size,
+            depth_min_m=args.depth_min,
+            confidence_threshold=args.confidence_threshold,
+            frame_skip=args.frame_skip,
+            min_translation=args.min_translation,
+            min_rotation=args.min_rotation,
+        )
 
     os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
-    o3d.io.write_triangle_mesh(args.output, mesh)
+    o3d.io.write_triangle_mesh(args.output, mesh,
+                               write_ascii=False, compressed=True)
     size_mb = os.path.getsize(args.output) / 1024**2
     print(f"\n✓ Saved: {args.output}  ({size_mb:.1f} MB)")
 
@@ -34,7 +34,9 @@ import open3d as o3d
 import numpy as np
 import json
 import argparse
+import re
 import os
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from PIL import Image
@@ -46,6 +48,23 @@ from scipy import ndimage
 # ---------------------------------------------------------------------------
 
 def load_trajectory_log(log_file):
+    # Prefer the binary sibling written by step 02 — a zero-copy mmap
+    # instead of parsing formatted floats.
+    npy = log_file + '.npy'
+    if os.path.exists(npy) and os.path.getmtime(npy) >= os.path.getmtime(log_file):
+        return np.load(npy, mmap_mode='r')
+    try:
+        # One read + one C-level number scan — no per-line Python
+        # iteration; the loop below only runs for malformed logs.
+        with open(log_file) as f:
+            text = f.read()
+        vals = np.fromstring(re.sub(r'#[^\n]*', '', text), sep=' ')
+        if vals.size and vals.size % 16 == 0:
+            # float32 poses halve the bandwidth into the integrator;
+            # Open3D casts to float64 at its API boundary where needed
+            return vals.reshape(-1, 4, 4).astype(np.float32)
+    except ValueError:
+        pass
     poses = []
     with open(log_file) as f:
         for line in f:
@@ -55,7 +74,20 @@ def load_trajectory_log(log_file):
             vals = [float(x) for x in line.split()]
             if len(vals) == 16:
                 poses.append(np.array(vals).reshape(4, 4))
-    return poses
+    if not poses:
+        return np.empty((0, 4, 4), np.float32)
+    return np.stack(poses).astype(np.float32)
+
+
+def invert_se3_batch(poses):
+    """Closed-form rigid-transform inverse [Rᵀ, -Rᵀt] over an (N,4,4)
+    stack — poses are SE(3), so the general LU path of np.linalg.inv is
+    wasted work, and batching removes the per-frame NumPy round trip."""
+    Rt  = poses[:, :3, :3].transpose(0, 2, 1)
+    inv = np.tile(np.eye(4, dtype=poses.dtype), (len(poses), 1, 1))
+    inv[:, :3, :3] = Rt
+    inv[:, :3,  3] = -np.einsum('nij,nj->ni', Rt, poses[:, :3, 3])
+    return inv
 
 
 def load_intrinsic(intrinsic_file):
@@ -68,16 +100,92 @@ def load_intrinsic(intrinsic_file):
     return intrinsic, d.get('depth_scale', 1000.0)
 
 
+def _frame_key(path):
+    """Numeric sort key on the frame index — correct even when indices
+    are not zero-padded, and cheaper than comparing padded strings."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
 def get_rgbd_file_lists(frames_dir):
     color_dir = os.path.join(frames_dir, 'color')
     depth_dir = os.path.join(frames_dir, 'depth')
-    color_files = sorted(os.path.join(color_dir, f) for f in os.listdir(color_dir)
-                         if f.endswith(('.jpg', '.png')))
-    depth_files = sorted(os.path.join(depth_dir, f) for f in os.listdir(depth_dir)
-                         if f.endswith('.png'))
+    # os.scandir returns cached DirEntry objects — no per-file stat
+    with os.scandir(color_dir) as it:
+        color_files = sorted((e.path for e in it
+                              if e.name.endswith(('.jpg', '.png'))),
+                             key=_frame_key)
+    # Dedupe depth by frame stem: a --fast_depth re-extraction over an
+    # existing dir leaves both NNNNNN.png and NNNNNN.npy, and a plain
+    # sorted listing would interleave them and shift every color<->depth
+    # pairing by one. The raw .npy wins when both exist.
+    by_stem = {}
+    with os.scandir(depth_dir) as it:
+        for e in it:
+            if e.name.endswith('.npy'):
+                by_stem[e.name[:-4]] = e.path
+            elif e.name.endswith('.png'):
+                by_stem.setdefault(e.name[:-4], e.path)
+    depth_files = sorted(by_stem.values(), key=_frame_key)
     return color_files, depth_files
 
 
+def load_depth(depth_file):
+    """Read a depth frame: PNG, or raw .npy from --fast_depth extraction."""
+    if depth_file.endswith('.npy'):
+        return np.load(depth_file)
+    return np.asarray(o3d.io.read_image(depth_file))
+
+
+def open_raw_stacks(frames_dir, need_color=True):
+    """Memory-mapped decoded frame stacks from preprocess_frames.py.
+
+    Returns (color_mem, depth_mem), or (None, None) when no raw_stack/
+    exists — callers then fall back to per-file decoding. Pass
+    need_color=False to skip the color stack (color_mem is None then);
+    for blosc2 stacks that avoids decompressing gigabytes nobody reads."""
+    meta_path = os.path.join(frames_dir, 'raw_stack', 'meta.json')
+    if not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # Staleness check against the key preprocess_frames.py recorded at
+    # decode time — re-extracted frames must not be fused from old pixels
+    color_files, depth_files = get_rgbd_file_lists(frames_dir)
+    key = [len(color_files), len(depth_files),
+           os.path.getmtime(color_files[-1]) if color_files else 0.0,
+           os.path.getmtime(depth_files[-1]) if depth_files else 0.0]
+    if meta.get('source_key') != key:
+        print("WARNING: raw_stack is stale (frames changed since "
+              "preprocess_frames.py ran) — falling back to per-file decode")
+        return None, None
+    n, h, w = meta['n_frames'], meta['height'], meta['width']
+    raw_dir = os.path.dirname(meta_path)
+    if meta.get('codec') == 'blosc2':
+        # zstd-compressed stacks (preprocess_frames.py --compress) —
+        # decompressed into RAM once; still far cheaper than PNG decode
+        try:
+            import blosc2
+        except ImportError:
+            print("WARNING: raw_stack is blosc2-compressed but blosc2 is "
+                  "not installed — falling back to per-file decode")
+            return None, None
+        color_mem = None
+        if need_color:
+            with open(os.path.join(raw_dir, 'color.blosc'), 'rb') as f:
+                color_mem = blosc2.unpack_array2(f.read())
+        with open(os.path.join(raw_dir, 'depth.blosc'), 'rb') as f:
+            depth_mem = blosc2.unpack_array2(f.read())
+        return color_mem, depth_mem
+    color_mem = None
+    if need_color:
+        color_mem = np.memmap(os.path.join(raw_dir, 'color.dat'),
+                              dtype=np.uint8, mode='r', shape=(n, h, w, 3))
+    depth_mem = np.memmap(os.path.join(raw_dir, 'depth.dat'), dtype=np.uint16,
+                          mode='r', shape=(n, h, w))
+    return color_mem, depth_mem
+
+
 def apply_depth_filter(depth_np, depth_scale, min_depth_m=0.15):
     min_raw = int(min_depth_m * depth_scale)
     invalid = (depth_np == 0) | (depth_np < min_raw)
@@ -174,20 +282,47 @@ def integrate_semantic_tsdf(frames_dir, intrinsic, poses, alpha_dir,
     print(f"\n  Semantic TSDF: {n_frames} frames")
 
     volume = _create_tsdf_volume(voxel_size, depth_max)
-    for idx in tqdm(range(n_frames), desc="Semantic TSDF"):
+
+    # All extrinsics in one vectorized batch, outside the hot loop
+    inv_poses = invert_se3_batch(np.asarray(poses[:n_frames]))
+
+    # Semantic pass only reads depth — skip the color stack entirely
+    _, depth_mem = open_raw_stacks(frames_dir, need_color=False)
+    if depth_mem is not None:
+        n_frames = min(n_frames, len(depth_mem))
+        print("  Raw memmap depth stack found (preprocess_frames.py) — decode skipped")
+
+    def _load_pair(idx):
         alpha_path = os.path.join(alpha_dir, f"alpha_{idx:06d}.npz")
         alpha    = np.load(alpha_path)['alpha']
         a_uint8  = (np.clip(alpha, 0.0, 1.0) * 255).astype(np.uint8)
         alpha_rgb = np.stack([a_uint8, a_uint8, a_uint8], axis=-1)
-        depth_np = np.asarray(o3d.io.read_image(depth_files[idx]))
+        depth_np = (np.asarray(depth_mem[idx]) if depth_mem is not None
+                    else load_depth(depth_files[idx]))
         depth_np = apply_depth_filter(depth_np, depth_scale, depth_min_m)
-        rgbd = o3d.geometry.RGBDImage.create_from_color_and_depth(
+        return o3d.geometry.RGBDImage.create_from_color_and_depth(
             o3d.geometry.Image(alpha_rgb),
-            o3d.geometry.Image(depth_np.astype(np.uint16)),
+            o3d.geometry.Image(
+                np.ascontiguousarray(depth_np, dtype=np.uint16)),
             depth_scale=depth_scale, depth_trunc=depth_max,
             convert_rgb_to_intensity=False,
         )
-        volume.integrate(rgbd, intrinsic, np.linalg.inv(poses[idx]))
+
+    # Decode frame i+K on a small pool while frame i integrates — zlib
+    # (npz alpha maps) and libpng release the GIL, so prefetching hides
+    # decode latency behind the (single-threaded) TSDF integration.
+    prefetch = 8
+    pool     = ThreadPoolExecutor(max_workers=max((os.cpu_count() or 4) // 2, 2))
+    futures  = deque(pool.submit(_load_pair, i)
+                     for i in range(min(prefetch, n_frames)))
+    try:
+        for idx in tqdm(range(n_frames), desc="Semantic TSDF"):
+            rgbd = futures.popleft().result()
+            if idx + prefetch < n_frames:
+                futures.append(pool.submit(_load_pair, idx + prefetch))
+            volume.integrate(rgbd, intrinsic, inv_poses[idx])
+    finally:
+        pool.shutdown(wait=False)
 
     print("  ✓ Semantic TSDF complete — extracting mesh…")
     mesh = volume.extract_triangle_mesh()
@@ -272,7 +407,8 @@ def main():
     )
 
     alpha_mesh_path = os.path.join(args.output_dir, 'alpha_mesh.ply')
-    o3d.io.write_triangle_mesh(alpha_mesh_path, alpha_mesh)
+    o3d.io.write_triangle_mesh(alpha_mesh_path, alpha_mesh,
+                               write_ascii=False, compressed=True)
     size_mb = os.path.getsize(alpha_mesh_path) / 1024**2
     print(f"\n✓ alpha_mesh.ply saved: {alpha_mesh_path}  ({size_mb:.1f} MB)")
     print(f"  alpha_maps/ : {alpha_dir}/")
@@ -228,7 +228,8 @@ def run_threshold(mesh, alpha_scores, threshold, hops, min_cluster_size,
 
     culled = cull_mesh_by_alpha(mesh, alpha_scores, threshold)
     culled_path = os.path.join(thresh_dir, 'culled_mesh_rgb.ply')
-    o3d.io.write_triangle_mesh(culled_path, culled)
+    o3d.io.write_triangle_mesh(culled_path, culled,
+                               write_ascii=False, compressed=True)
     print(f"  ✓ culled_mesh_rgb.ply  ({os.path.getsize(culled_path)/1024**2:.1f} MB)")
     del culled
 
@@ -238,7 +239,8 @@ def run_threshold(mesh, alpha_scores, threshold, hops, min_cluster_size,
     vertex_labels = segment_mesh_with_boundaries(mesh, is_boundary_final)
 
     seg_color = make_segment_color_mesh(mesh, vertex_labels)
-    o3d.io.write_triangle_mesh(os.path.join(thresh_dir, 'segments.ply'), seg_color)
+    o3d.io.write_triangle_mesh(os.path.join(thresh_dir, 'segments.ply'),
+                               seg_color, write_ascii=False, compressed=True)
     print(f"  ✓ segments.ply")
     del seg_color
 
@@ -257,7 +259,8 @@ def run_threshold(mesh, alpha_scores, threshold, hops, min_cluster_size,
         sub.remove_unreferenced_vertices()
         sub.compute_vertex_normals()
         o3d.io.write_triangle_mesh(
-            os.path.join(segments_dir, f"segment_{label:04d}.ply"), sub)
+            os.path.join(segments_dir, f"segment_{label:04d}.ply"), sub,
+            write_ascii=False, compressed=True)
         saved += 1
         del sub
     print(f"  ✓ {saved} segments saved → {segments_dir}/")
@@ -319,7 +322,8 @@ def main():
 
     score_map = make_boundary_score_mesh(raw_mesh, 1.0 - alpha_scores)
     score_path = os.path.join(args.output_dir, 'score_map_mesh.ply')
-    o3d.io.write_triangle_mesh(score_path, score_map)
+    o3d.io.write_triangle_mesh(score_path, score_map,
+                               write_ascii=False, compressed=True)
     print(f"  ✓ score_map_mesh.ply → {score_path}")
     del score_map
 